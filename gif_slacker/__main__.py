@@ -1,4 +1,6 @@
 import argparse
+import signal
+import subprocess
 import sys
 from shutil import which
 from decimal import Decimal
@@ -180,7 +182,17 @@ def main() -> int:
         parser.print_help()
         return 2
 
-    return args._do(args)
+    # a terminated run still cleans up after itself, raw frames left in
+    # /dev/shm would take up memory until the next reboot
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(128 + signum))
+
+    try:
+        return args._do(args)
+    except subprocess.CalledProcessError as e:
+        print(f"{e.cmd[0]} failed with exit status {e.returncode}", file=sys.stderr)
+        if e.stderr:
+            print(e.stderr.decode(errors="replace").rstrip(), file=sys.stderr)
+        return 1
 
 
 if __name__ == "__main__":
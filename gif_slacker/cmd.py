@@ -4,9 +4,26 @@ import os
 from shlex import join
 
 
-def cmd(*args: t.List[t.Any], check=False) -> t.Tuple[int, str, str]:
+def debug() -> bool:
+    return os.environ.get("DEBUG", "") not in ("0", "")
+
+
+def _output(capture: bool) -> t.Optional[int]:
+    if capture:
+        return subprocess.PIPE
+    # output that is not captured is only shown when debugging
+    return None if debug() else subprocess.DEVNULL
+
+
+def cmd(*args: t.List[t.Any], check=False, capture=True) -> t.Tuple[int, str, str]:
     params = list(map(str, args))
-    if os.environ.get("DEBUG", "") not in ("0", ""):
+    if debug():
         print(f"[cmd] {join(params)}")
-    out = subprocess.run(params, capture_output=True, check=check)
+    stderr = _output(capture)
+    if check and stderr == subprocess.DEVNULL:
+        # errors are small and they are the only way to tell why a command
+        # failed, they end up in the raised CalledProcessError
+        stderr = subprocess.PIPE
+    out = subprocess.run(params, stdout=_output(capture), stderr=stderr, check=check)
     return (out.returncode, out.stdout, out.stderr)
+
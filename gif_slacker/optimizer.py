@@ -1,19 +1,29 @@
 import tempfile
-import re
+import os
+import json
+import hashlib
 import typing as t
-import secrets
+import itertools
+import shutil
 import sys
+import warnings
 from pathlib import Path
-from math import ceil
+from math import ceil, exp, log, prod
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import nullcontext
+from multiprocessing import Manager
+from threading import Event
+from time import monotonic, time as wall_time
 
-import optuna
+from .cmd import cmd, debug
 
-from .cmd import cmd
+# optuna is slow to import, so it is only imported when optimizing
+if t.TYPE_CHECKING:
+    import optuna
 
 
-fps_re = re.compile(rb"r_frame_rate=(\d+)/(\d+)")
-width_re = re.compile(rb"width=(\d+)")
-height_re = re.compile(rb"height=(\d+)")
+shm_dir = Path("/dev/shm")
 
 
 class Optimizer:
@@ -21,23 +31,111 @@ class Optimizer:
     LOSSY_MIN = 0
     LOSSY_MAX = 200
 
+    PALETTE_FRAMES = 256
+
+    # lossless intra only codecs that decode about as fast as raw frames
+    CHEAP_CODECS = {"rawvideo", "ffv1", "huffyuv", "ffvhuff", "utvideo", "magicyuv"}
+
+    FFMPEG_CACHE_SIZE = 16
+
+    GIF_CACHE_VIDEOS = 8
+    # bumped whenever the same parameters start giving other gifs
+    GIF_CACHE_VERSION = 1
+    GIF_CACHE_BYTES = 32 * 10 ** 6
+    # partial directories unused for this long belong to runs that are gone
+    GIF_CACHE_IDLE = 24 * 60 * 60
+
     def __init__(self, video_file: Path, *, dir: Path = None):
         self.video_file = video_file
 
         self.tmp = Path(tempfile.mkdtemp(dir=dir))
-        self.palette = self.tmp / "palette.png"
-        self.intermediate = self.tmp / "intermediate.avi"
+        self.gifs = self.tmp
+        self.partial = self.tmp
+        self.palette = self.gifs / "palette.png"
+        self._has_palette = False
+        self.intermediate: t.Optional[Path] = None
+        self.intermediate_fps = None
+        self.intermediate_raw: t.Optional[t.Tuple[int, int]] = None
+        self.shm: t.Optional[Path] = None
+
+        self._ffmpeg_cache: t.OrderedDict[t.Tuple[int, int], Path] = OrderedDict()
+        self._ffmpeg_cache_size = self.FFMPEG_CACHE_SIZE
+        self._published: t.Dict[t.Tuple[int, int], Path] = {}
+        self._gif_cache: t.Dict[t.Tuple[int, int, int], t.Tuple[Path, int]] = {}
+
+        self._materialized: t.Dict[str, int] = {}
+        self._shared = False
+
+        self._tmp_counter = itertools.count()
+
+        self._threads = 0
 
         self._update_fps_and_size()
 
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state["_tmp_counter"]
+        state["_ffmpeg_cache"] = OrderedDict()
+        state["_published"] = {}
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._tmp_counter = itertools.count()
+
     def __enter__(self):
         return self
 
     def __exit__(self, type, value, traceback):
-        for file in self.tmp.glob("*.gif"):
-            file.unlink()
+        if self.gifs != self.tmp:
+            try:
+                os.utime(self.gifs.parent)
+            except OSError:
+                pass
+            prune_gifs(self.gifs.parent, self.GIF_CACHE_BYTES)
+
+        shutil.rmtree(self.partial, ignore_errors=True)
+        shutil.rmtree(self.tmp, ignore_errors=True)
+
+        if self.shm is not None:
+            shutil.rmtree(self.shm, ignore_errors=True)
+
+    def _video_id(self) -> str:
+        stat = Path(self.video_file).stat()
+        return f"{Path(self.video_file).resolve()}:{stat.st_mtime_ns}:{stat.st_size}"
+
+    def _open_gif_cache(self, fps: int, size: int, source: str):
+        try:
+            videos = cache_dir() / "gifs"
+            video = videos / hashlib.sha256(self._video_id().encode()).hexdigest()
+            gifs = video / f"{self.GIF_CACHE_VERSION}-{source}-{fps_key(fps)}-{size}"
+            gifs.mkdir(parents=True, exist_ok=True)
+            os.utime(video)
+            partial = Path(tempfile.mkdtemp(dir=gifs, prefix="partial-"))
+        except OSError as e:
+            print(f"not keeping gifs between runs: {e}", file=sys.stderr)
+            return
+
+        self.gifs = gifs
+        self.partial = partial
+        self.palette = gifs / "palette.png"
+        self._has_palette = self.palette.exists()
+        self._materialized = {file.name: stat.st_size for stat, file in stat_files(gifs.glob("*-*-*.gif"))}
+
+        prune_videos(videos, self.GIF_CACHE_VIDEOS, self.GIF_CACHE_IDLE)
+
+    def _probe(self) -> t.Tuple[t.Dict[str, t.Any], bytes]:
+        entries = "stream=codec_name,r_frame_rate,width,height,nb_frames:format=duration"
+
+        cache_file = None
+        try:
+            key = f"{self._video_id()}:{entries}"
+            cache_file = cache_dir() / "probe" / f"{hashlib.sha256(key.encode()).hexdigest()}.json"
+            stdout = cache_file.read_bytes()
+            return json.loads(stdout), stdout
+        except (OSError, ValueError):
+            pass
 
-    def _update_fps_and_size(self) -> t.Tuple[int, int]:
         _, stdout, _ = cmd(
             "ffprobe",
             "-v",
@@ -45,112 +143,380 @@ class Optimizer:
             "-select_streams",
             "v:0",
             "-show_entries",
-            "stream=r_frame_rate,width,height",
+            entries,
             "-of",
-            "default=nw=1",
+            "json",
             self.video_file,
         )
 
-        fps = fps_re.search(stdout)
-        if fps is None:
+        try:
+            info = json.loads(stdout)
+        except ValueError:
+            print(stdout, file=sys.stderr)
+            raise ValueError("could not parse the output of ffprobe")
+
+        if cache_file is None:
+            return info, stdout
+
+        try:
+            cache_file.parent.mkdir(parents=True, exist_ok=True)
+            cache_file_tmp = cache_file.with_name(f"{cache_file.name}.{os.getpid()}")
+            cache_file_tmp.write_bytes(stdout)
+            os.replace(cache_file_tmp, cache_file)
+        except OSError:
+            pass
+
+        return info, stdout
+
+    def _update_fps_and_size(self):
+        info, stdout = self._probe()
+        stream = (info.get("streams") or [{}])[0]
+
+        num, _, den = stream.get("r_frame_rate", "").partition("/")
+        if not (num.isdigit() and den.isdigit()) or int(den) == 0:
             print(stdout, file=sys.stderr)
             raise ValueError("could not get fps of the video")
-        self.fps = int(fps[1]) / int(fps[2])
+        self.fps = int(num) / int(den)
 
-        width = width_re.search(stdout)
-        if width is None:
+        if "width" not in stream:
             raise ValueError("could not get width of the video")
-        self.width = int(width[1])
+        self.width = int(stream["width"])
 
-        height = height_re.search(stdout)
-        if height is None:
+        if "height" not in stream:
             raise ValueError("could not get height of the video")
-        self.height = int(height[1])
+        self.height = int(stream["height"])
 
-    def _temp_file(self) -> Path:
-        return self.tmp / f"{secrets.token_urlsafe()}.gif"
+        try:
+            self.duration = float(info["format"]["duration"])
+        except (KeyError, ValueError):
+            self.duration = None
 
-    def _file_name(self, fps, size, lossy=None) -> str:
-        if lossy is None:
-            return f"{fps}-{size}.gif"
-        return f"{fps}-{size}-{lossy}.gif"
+        try:
+            self.nb_frames = int(stream["nb_frames"])
+        except (KeyError, ValueError):
+            self.nb_frames = 0
 
-    def _create_palette(self):
-        if self.palette.exists():
-            return
+        self.codec = stream.get("codec_name")
+
+    def _frames(self, fps: float) -> t.Optional[float]:
+        if self.duration is not None:
+            return self.duration * fps
+        if self.nb_frames > 0:
+            return self.nb_frames * fps / self.fps
+        return None
+
+    def _scaled_height(self, size: int) -> int:
+        return max(1, round(self.height * size / self.width))
+
+    def _pixels(self, fps: float, size: int) -> t.Optional[float]:
+        frames = self._frames(fps)
+        if frames is None:
+            return None
+
+        return frames * size * self._scaled_height(size)
+
+    def _palette_partial(self) -> Path:
+        return self.partial / f"palette-{os.getpid()}.png"
+
+    def _ffmpeg_path(self, fps: float, size: int) -> Path:
+        return self.tmp / f"{fps_key(fps)}-{size}.{os.getpid()}.gif"
+
+    def _shared_ffmpeg_path(self, fps: float, size: int) -> Path:
+        return self.tmp / f"{fps_key(fps)}-{size}.gif"
+
+    def _gif_path(self, fps: float, size: int, lossy: int) -> Path:
+        return self.gifs / f"{fps_key(fps)}-{size}-{lossy}.gif"
+
+    def _temp_file(self, dir: Path) -> Path:
+        return dir / f"tmp-{os.getpid()}-{next(self._tmp_counter)}.gif"
+
+    def _materialized_size(self, file: Path) -> t.Optional[int]:
+        size = self._materialized.get(file.name)
+        if size is None and self._shared:
+            try:
+                size = self._materialized[file.name] = file.stat().st_size
+            except FileNotFoundError:
+                pass
+        return size
+
+    def _materialize(self, file: Path, output_file: Path) -> t.Tuple[Path, int]:
+        size = file.stat().st_size
+        os.replace(file, output_file)
+        self._materialized[output_file.name] = size
+        return output_file, size
 
-        input_file = self.video_file
-        if self.intermediate.exists():
-            input_file = self.intermediate
+    def _ffmpeg(self) -> t.List[t.Any]:
+        # without -nostdin parallel workers compete for the terminal
+        args = ["ffmpeg", "-nostdin", "-hide_banner"]
+        threads = str(self._threads)
+        args += ["-threads", threads, "-filter_threads", threads, "-filter_complex_threads", threads]
+        if not debug():
+            args += ["-loglevel", "error", "-nostats"]
+        return args
 
+    def _palette_filter(self, fps: float) -> str:
+        frames = self._frames(fps)
+        step = 1
+        if frames is not None:
+            step = int(frames / self.PALETTE_FRAMES)
+
+        if step <= 1:
+            return "palettegen"
+        return f"select='not(mod(n,{step}))',palettegen"
+
+    def _fuse_palette(self, fps: int, size: int) -> bool:
+        # paletteuse buffers every frame until palettegen has seen the last one
+        pixels = self._pixels(fps, size)
+        memory = available_memory()
+        return pixels is not None and memory is not None and pixels * 4 < memory // 2
+
+    def _create_palette(self, fps: int, size: int):
         print("generating palette")
 
         cmd(
-            "ffmpeg",
-            "-i",
-            input_file,
+            *self._ffmpeg(),
+            "-y",
+            *self._input_args(),
             "-vf",
-            "palettegen",
-            self.palette,
+            f"{fps_filter(self.fps, fps)},scale={size}:-1:flags=lanczos,{self._palette_filter(fps)}",
+            self._palette_partial(),
             check=True,
+            capture=False,
         )
+        os.replace(self._palette_partial(), self.palette)
+        self._has_palette = True
 
-    def _create_intermediate(self, fps: int, size: int):
-        output_file = self.intermediate
-        if output_file.exists():
-            return output_file
+    def _intermediate_in_memory(self, fps: int, width: int, height: int) -> bool:
+        if self.duration is None or not shm_dir.is_dir():
+            return False
+
+        # raw rgb24 frames, leave at least half of the tmpfs free
+        size = ceil(self.duration * fps) * width * height * 3
+        return size < shutil.disk_usage(shm_dir).free // 2
+
+    def _use_intermediate(self, fps: int, size: int) -> bool:
+        if fps >= self.fps and size >= self.width:
+            return False
+
+        if self.codec in self.CHEAP_CODECS:
+            return fps / self.fps * (size / self.width) ** 2 < 0.5
+
+        return True
 
-        print("creating intermediate file for faster processing")
+    def _create_intermediate(self, fps: int, size: int, in_memory: bool):
+        if self.intermediate is not None and self._has_palette:
+            return self.intermediate
+
+        print("creating intermediate file and palette for faster processing")
+
+        height = self._scaled_height(size)
+        raw = None
+        if in_memory:
+            self.shm = Path(tempfile.mkdtemp(dir=shm_dir))
+            output_file = self.shm / "intermediate.raw"
+            output_args = ["-f", "rawvideo", "-pix_fmt", "rgb24"]
+            raw = (size, height)
+        else:
+            output_file = self.tmp / "intermediate.avi"
+            output_args = ["-c:v", "ffv1"]
 
         cmd(
-            "ffmpeg",
+            *self._ffmpeg(),
             "-y",
             "-i",
             self.video_file,
-            "-vf",
-            f"fps={fps},scale={size}:-1:flags=lanczos",
+            "-filter_complex",
+            f"[0:v]fps={fps},scale={size}:{height}:flags=lanczos,split[a][b];[a]{self._palette_filter(fps)}[p]",
+            "-map",
+            "[b]",
+            *output_args,
             output_file,
+            "-map",
+            "[p]",
+            self._palette_partial(),
             check=True,
+            capture=False,
         )
+        os.replace(self._palette_partial(), self.palette)
 
-    def _to_gif_ffmpeg(self, fps: int, size: int) -> Path:
-        input_file = self.video_file
-        if self.intermediate.exists():
-            input_file = self.intermediate
+        self.intermediate = output_file
+        self.intermediate_fps = fps
+        self.intermediate_raw = raw
+        self._has_palette = True
+        return output_file
+
+    def _input_args(self) -> t.List[t.Any]:
+        if self.intermediate is None:
+            return ["-i", self.video_file]
+
+        if self.intermediate_raw is None:
+            return ["-i", self.intermediate]
+
+        width, height = self.intermediate_raw
+        return [
+            "-f",
+            "rawvideo",
+            "-pix_fmt",
+            "rgb24",
+            "-s",
+            f"{width}x{height}",
+            "-framerate",
+            self.intermediate_fps,
+            "-i",
+            self.intermediate,
+        ]
+
+    def _to_gif_ffmpeg_args(self, fps: int, size: int, output_file: t.Any) -> t.List[t.Any]:
+        input_fps = self.fps
+        if self.intermediate is not None:
+            input_fps = self.intermediate_fps
+
+        scale = f"{fps_filter(input_fps, fps)},scale={size}:-1:flags=lanczos"
+        output_args = ["-vsync", "0", "-loop", "0", "-f", "gif", output_file]
 
-        output_file = self.tmp / self._file_name(fps, size)
-        if output_file.exists():
+        if self._has_palette:
+            return [
+                *self._ffmpeg(),
+                "-y",
+                *self._input_args(),
+                "-i",
+                self.palette,
+                "-lavfi",
+                f"{scale},paletteuse",
+                *output_args,
+            ]
+
+        return [
+            *self._ffmpeg(),
+            "-y",
+            *self._input_args(),
+            "-filter_complex",
+            f"[0:v]{scale},split[a][b];[a]{self._palette_filter(fps)},split[p][q];[b][p]paletteuse[g]",
+            "-map",
+            "[g]",
+            *output_args,
+            "-map",
+            "[q]",
+            self._palette_partial(),
+        ]
+
+    def _to_gif_ffmpeg(self, fps: int, size: int) -> Path:
+        key = (fps_key(fps), size)
+        output_file = self._ffmpeg_cache.get(key)
+        if output_file is not None:
+            self._ffmpeg_cache.move_to_end(key)
             return output_file
 
-        output_file_tmp = self._temp_file()
+        if self._link_ffmpeg(fps, size):
+            return self._cache_ffmpeg(key, self._ffmpeg_path(fps, size))
+
+        output_file_tmp = self._temp_file(self.tmp)
 
         # TODO better error handling
+        cmd(*self._to_gif_ffmpeg_args(fps, size, output_file_tmp), check=True, capture=False)
+
+        output_file = self._add_ffmpeg(fps, size, output_file_tmp)
+        if not self._has_palette:
+            os.replace(self._palette_partial(), self.palette)
+            self._has_palette = True
+        return output_file
+
+    def _to_gif_ffmpeg_batch(self, pairs: t.List[t.Tuple[int, int]]):
+        missing = {}
+        for fps, size in pairs:
+            key = (fps_key(fps), size)
+            if key in self._ffmpeg_cache:
+                self._ffmpeg_cache.move_to_end(key)
+            elif self._link_ffmpeg(fps, size):
+                self._cache_ffmpeg(key, self._ffmpeg_path(fps, size))
+            else:
+                missing[key] = (fps, size)
+
+        if len(missing) <= 1 or not self._has_palette:
+            for fps, size in missing.values():
+                self._to_gif_ffmpeg(fps, size)
+            return
+
+        input_fps = self.fps
+        if self.intermediate is not None:
+            input_fps = self.intermediate_fps
+
+        n = len(missing)
+        graph = [
+            "[0:v]split=" + str(n) + "".join(f"[s{i}]" for i in range(n)),
+            "[1:v]split=" + str(n) + "".join(f"[p{i}]" for i in range(n)),
+        ]
+        outputs = []
+        output_args = []
+        for i, (fps, size) in enumerate(missing.values()):
+            graph.append(f"[s{i}]{fps_filter(input_fps, fps)},scale={size}:-1:flags=lanczos[v{i}]")
+            graph.append(f"[v{i}][p{i}]paletteuse[g{i}]")
+            output_file_tmp = self._temp_file(self.tmp)
+            outputs.append(output_file_tmp)
+            output_args += ["-map", f"[g{i}]", "-vsync", "0", "-loop", "0", "-f", "gif", output_file_tmp]
+
         cmd(
-            "ffmpeg",
+            *self._ffmpeg(),
             "-y",
-            "-i",
-            input_file,
+            *self._input_args(),
             "-i",
             self.palette,
-            "-lavfi",
-            f"fps={fps:.2f},scale={size}:-1:flags=lanczos,paletteuse",
-            "-loop",
-            "0",
-            output_file_tmp,
+            "-filter_complex",
+            ";".join(graph),
+            *output_args,
             check=True,
+            capture=False,
         )
 
-        output_file_tmp.rename(output_file)
-        return output_file
+        for (fps, size), output_file_tmp in zip(missing.values(), outputs):
+            self._add_ffmpeg(fps, size, output_file_tmp)
+
+    def _link_ffmpeg(self, fps: float, size: int) -> bool:
+        # the link keeps a render of another worker until this one evicts it
+        if not self._shared:
+            return False
+        try:
+            os.link(self._shared_ffmpeg_path(fps, size), self._ffmpeg_path(fps, size))
+        except FileNotFoundError:
+            return False
+        return True
+
+    def _add_ffmpeg(self, fps: float, size: int, file: Path) -> Path:
+        key = (fps_key(fps), size)
+        output_file = self._ffmpeg_path(fps, size)
+        os.replace(file, output_file)
+        if self._shared:
+            try:
+                os.link(output_file, self._shared_ffmpeg_path(fps, size))
+                self._published[key] = self._shared_ffmpeg_path(fps, size)
+            except FileExistsError:
+                pass
+        return self._cache_ffmpeg(key, output_file)
+
+    def _cache_ffmpeg(self, key: t.Tuple[int, int], file: Path) -> Path:
+        self._ffmpeg_cache[key] = file
+        while len(self._ffmpeg_cache) > self._ffmpeg_cache_size:
+            evicted_key, evicted = self._ffmpeg_cache.popitem(last=False)
+            evicted.unlink()
+            published = self._published.pop(evicted_key, None)
+            if published is not None:
+                published.unlink(missing_ok=True)
+        return file
 
     def _to_gif(self, fps: int, size: int, lossy: int) -> t.Tuple[Path, int]:
-        created_file = self._to_gif_ffmpeg(fps, size)
+        key = (fps_key(fps), size, lossy)
+        result = self._gif_cache.get(key)
+        if result is not None:
+            return result
 
-        output_file = self.tmp / self._file_name(fps, size, lossy)
-        if output_file.exists():
-            return output_file, output_file.stat().st_size
+        output_file = self._gif_path(fps, size, lossy)
+        file_size = self._materialized_size(output_file)
+        if file_size is not None:
+            result = self._gif_cache[key] = (output_file, file_size)
+            return result
 
-        output_file_tmp = self._temp_file()
+        created_file = self._to_gif_ffmpeg(fps, size)
+        output_file_tmp = self._temp_file(self.partial)
 
         # TODO better error handling
         cmd(
@@ -161,10 +527,11 @@ class Optimizer:
             "-o",
             output_file_tmp,
             check=True,
+            capture=False,
         )
 
-        output_file_tmp.rename(output_file)
-        return output_file, output_file.stat().st_size
+        result = self._gif_cache[key] = self._materialize(output_file_tmp, output_file)
+        return result
 
     def optimize(
         self,
@@ -213,60 +580,463 @@ class Optimizer:
             sep="\n\t"
         )
 
-        if fps_max < self.fps or size_max < self.width:
-            self._create_intermediate(fps_max, size_max)
-
-        self._create_palette()
+        if jobs == -1:
+            jobs = os.cpu_count() or 1
+        self._shared = jobs > 1
 
-        def objective(trial: optuna.Trial) -> float:
-            fps = trial.suggest_float("fps", fps_min, fps_max)
-            size = trial.suggest_int("size", size_min, size_max, log=True)
-            lossy = trial.suggest_int("lossy", lossy_min, lossy_max)
+        use_intermediate = self._use_intermediate(fps_max, size_max)
+        in_memory = use_intermediate and self._intermediate_in_memory(
+            fps_max, size_max, self._scaled_height(size_max)
+        )
+        source = "source"
+        if use_intermediate:
+            source = "raw" if in_memory else "ffv1"
+        self._open_gif_cache(fps_max, size_max, source)
 
-            _, size = self._to_gif(fps, size, lossy)
-            if size > output_size_limit:
-                return output_size_limit + (size - output_size_limit) ** 2
+        reference = None
+        if use_intermediate:
+            self._create_intermediate(fps_max, size_max, in_memory)
+        elif self._has_palette or self._fuse_palette(fps_max, size_max):
+            if not self._has_palette:
+                print("generating palette")
+            self._to_gif_ffmpeg(fps_max, size_max)
+            reference = {"size": size_max}
+        else:
+            self._create_palette(fps_max, size_max)
 
-            # fps should affect file size linearly
-            dist_fps = delta(fps_min, fps_max, fps)
+        objective = Objective(
+            self,
+            output_size_limit=output_size_limit,
+            fps_min=fps_min,
+            fps_max=fps_max,
+            size_min=size_min,
+            size_max=size_max,
+            lossy_min=lossy_min,
+            lossy_max=lossy_max,
+        )
 
-            # image size should affect file size exponentially
-            dist_size = delta(size_min, size_max, size)
-            dist_size **= 0.75
+        storage = None
+        if jobs > 1:
+            storage = f"sqlite:///{self.tmp / 'study.db'}"
 
-            # compression is likely to affect file size logarithmically
-            dist_lossy = 1.0 - delta(lossy_min, lossy_max, lossy)
-            dist_lossy **= 2.5
+        batch_size = max(1, (os.cpu_count() or 1) // jobs)
+        self._threads = batch_size if jobs > 1 else 0
+        # renders of a batch may not be evicted while gifsicle still reads them
+        self._ffmpeg_cache_size = max(self.FFMPEG_CACHE_SIZE, batch_size)
 
-            dist = dist_fps + dist_size + dist_lossy
+        import optuna
 
-            if dist == 0:
-                return float("inf")
+        study = optuna.create_study(study_name="gif-slacker", storage=storage)
 
-            return (1 + output_size_limit - size) / dist
+        with warnings.catch_warnings():
+            # enqueueing trials is still experimental in optuna 2
+            warnings.simplefilter("ignore", optuna.exceptions.ExperimentalWarning)
 
-        study = optuna.create_study()
+            grid = objective.grid()
+            if grid is not None and trials is not None and prod(map(len, grid.values())) <= trials:
+                trials = prod(map(len, grid.values()))
+                for params in itertools.product(*grid.values()):
+                    study.enqueue_trial(dict(zip(grid.keys(), params)))
+            elif reference is not None:
+                study.enqueue_trial({"fps": objective.fps_high, **reference})
 
         try:
             print(f"starting optimization with {trials=} {timeout=} {jobs=}")
-            study.optimize(objective, n_trials=trials, timeout=timeout, n_jobs=jobs)
+            if jobs == 1:
+                run_trials(study, objective, trials, timeout, batch_size)
+            else:
+                # SQLite does not lock rows, workers could pop the same enqueued trial
+                with Manager() as manager, ProcessPoolExecutor(max_workers=jobs) as executor:
+                    ask_lock = manager.Lock()
+                    stop = manager.Event()
+                    futures = [
+                        executor.submit(
+                            optimize_worker,
+                            objective,
+                            study.study_name,
+                            storage,
+                            n_trials,
+                            timeout,
+                            batch_size,
+                            ask_lock,
+                            stop,
+                        )
+                        for n_trials in split_trials(trials, jobs)
+                    ]
+                    try:
+                        for future in futures:
+                            future.result()
+                    except BaseException:
+                        # workers do not get signals sent only to this process
+                        try:
+                            stop.set()
+                        except (OSError, EOFError):
+                            pass
+                        raise
         except KeyboardInterrupt:
             print("user stopped optimization")
 
-        best = study.best_params
-        fps, size, lossy = best["fps"], best["size"], best["lossy"]
+        # lossy is not a parameter of the study
+        best = study.best_trial
+        fps, size, lossy = best.params["fps"], best.params["size"], best.user_attrs["lossy"]
         print(f"best results came with {fps=:.2f} {size=} {lossy=}")
 
-        best_gif = self.tmp / self._file_name(fps, size, lossy)
-        if best_gif.stat().st_size > output_size_limit:
+        best_gif, best_size = self._to_gif(fps, size, lossy)
+        if not best_gif.exists():
+            self._gif_cache.pop((fps_key(fps), size, lossy), None)
+            self._materialized.pop(best_gif.name, None)
+            best_gif, best_size = self._to_gif(fps, size, lossy)
+        if best_size > output_size_limit:
             print("best generated gif is larger than the output size limit")
-        best_gif.rename(output_file)
+        shutil.copyfile(best_gif, output_file)
 
         return 0
 
 
+def cache_dir() -> Path:
+    cache_home = os.environ.get("XDG_CACHE_HOME") or Path.home() / ".cache"
+    return Path(cache_home) / "gif-slacker"
+
+
+def available_memory() -> t.Optional[int]:
+    try:
+        return os.sysconf("SC_AVPHYS_PAGES") * os.sysconf("SC_PAGE_SIZE")
+    except (ValueError, OSError):
+        return None
+
+
+def stat_files(files: t.Iterable[Path]) -> t.List[t.Tuple[os.stat_result, Path]]:
+    stats = []
+    try:
+        for file in files:
+            try:
+                stats.append((file.stat(), file))
+            except OSError:
+                pass
+    except OSError:
+        pass
+    return stats
+
+
+def prune_videos(videos: Path, keep: int, idle: float):
+    old = sorted(stat_files(videos.iterdir()), key=lambda video: video[0].st_mtime, reverse=True)
+    for _, video in old[keep:]:
+        # a recently used partial directory means a run is still going
+        partial = stat_files(video.glob("*/partial-*"))
+        if any(stat.st_mtime > wall_time() - idle for stat, _ in partial):
+            continue
+        shutil.rmtree(video, ignore_errors=True)
+
+
+def prune_gifs(video: Path, max_bytes: int):
+    gifs = stat_files(video.glob("*/*-*-*.gif"))
+
+    gifs.sort(key=lambda gif: gif[0].st_mtime, reverse=True)
+    total = 0
+    for stat, file in gifs:
+        total += stat.st_size
+        if total > max_bytes:
+            file.unlink(missing_ok=True)
+
+
+def fps_key(fps: float) -> int:
+    return round(float(fps) * 100)
+
+
+def fps_filter(input_fps: float, fps: float) -> str:
+    fps = fps_key(fps) / 100
+    step = round(input_fps / fps)
+    if abs(input_fps / step - fps) < 0.005:
+        if step == 1:
+            return "null"
+        return f"select='not(mod(n,{step}))'"
+    return f"fps={fps:.2f}"
+
+
+def solve(a: t.List[t.List[float]], b: t.List[float]) -> t.Optional[t.List[float]]:
+    # gaussian elimination with partial pivoting, None when a is singular
+    n = len(b)
+    rows = [[*row, y] for row, y in zip(a, b)]
+    scale = max(abs(rows[i][i]) for i in range(n)) or 1.0
+    for i in range(n):
+        pivot = max(range(i, n), key=lambda r: abs(rows[r][i]))
+        if abs(rows[pivot][i]) < 1e-12 * scale:
+            return None
+        rows[i], rows[pivot] = rows[pivot], rows[i]
+        for r in range(i + 1, n):
+            f = rows[r][i] / rows[i][i]
+            for c in range(i, n + 1):
+                rows[r][c] -= f * rows[i][c]
+
+    x = [0.0] * n
+    for i in reversed(range(n)):
+        x[i] = (rows[i][n] - sum(rows[i][c] * x[c] for c in range(i + 1, n))) / rows[i][i]
+    return x
+
+
 def delta(min: int, max: int, x: int) -> float:
     div = abs(min - max)
     if div == 0:
         return 1.0
     return abs(min - x) / div
+
+
+class Objective:
+    LOSSY_STEP = 5
+
+    # gifs estimated to be this many times over the limit are not rendered
+    ESTIMATE_MARGIN = 2
+
+    def __init__(
+        self,
+        optimizer: Optimizer,
+        *,
+        output_size_limit: int,
+        fps_min: int,
+        fps_max: int,
+        size_min: int,
+        size_max: int,
+        lossy_min: int,
+        lossy_max: int,
+    ):
+        self.optimizer = optimizer
+        self.output_size_limit = output_size_limit
+        self.fps_min, self.fps_max = fps_min, fps_max
+        self.size_min, self.size_max = size_min, size_max
+        self.lossy_min, self.lossy_max = lossy_min, lossy_max
+        self.estimator = SizeEstimator()
+
+        # fps steps down from fps_max in whole frames per second
+        fps_max_key = fps_key(fps_max)
+        self.fps_steps = (fps_max_key - fps_key(fps_min)) // 100
+        self.fps_step = 1 if self.fps_steps > 0 else None
+        self.fps_low = (fps_max_key - 100 * self.fps_steps) / 100 if self.fps_steps > 0 else fps_min
+        self.fps_high = fps_max_key / 100 if self.fps_steps > 0 else fps_max
+
+        self.lossy_high = lossy_min + (lossy_max - lossy_min) // self.LOSSY_STEP * self.LOSSY_STEP
+
+    def grid(self) -> t.Optional[t.Dict[str, t.List[t.Any]]]:
+        if self.fps_step is None and self.fps_low != self.fps_high:
+            return None
+
+        fps_low_key = fps_key(self.fps_low)
+        return {
+            "fps": [(fps_low_key + 100 * i) / 100 for i in range(self.fps_steps + 1)],
+            "size": list(range(self.size_min, self.size_max + 1)),
+        }
+
+    def lossy_values(self) -> t.List[int]:
+        return list(range(self.lossy_min, self.lossy_high + 1, self.LOSSY_STEP))
+
+    def suggest(self, trial: "optuna.Trial") -> t.Tuple[float, int]:
+        fps = trial.suggest_float("fps", self.fps_low, self.fps_high, step=self.fps_step)
+        size = trial.suggest_int("size", self.size_min, self.size_max, log=True)
+        return fps, size
+
+    def estimate(self, trial: "optuna.Trial", fps: float, size: int) -> t.Optional[float]:
+        output_size_limit = self.output_size_limit
+        estimate = self.estimator.estimate(self.optimizer._pixels(fps, size), self.lossy_high)
+        if estimate is None or estimate <= self.ESTIMATE_MARGIN * output_size_limit:
+            return None
+
+        trial.set_user_attr("estimated", True)
+        return output_size_limit + (estimate - output_size_limit) ** 2
+
+    def value(self, fps: float, size: int, lossy: int, file_size: int) -> float:
+        output_size_limit = self.output_size_limit
+
+        if file_size > output_size_limit:
+            return output_size_limit + (file_size - output_size_limit) ** 2
+
+        # fps should affect file size linearly
+        dist_fps = delta(self.fps_min, self.fps_max, fps)
+
+        # image size should affect file size exponentially
+        dist_size = delta(self.size_min, self.size_max, size)
+        dist_size **= 0.75
+
+        # compression is likely to affect file size logarithmically
+        dist_lossy = 1.0 - delta(self.lossy_min, self.lossy_max, lossy)
+        dist_lossy **= 2.5
+
+        dist = dist_fps + dist_size + dist_lossy
+
+        if dist == 0:
+            return float("inf")
+
+        return (1 + output_size_limit - file_size) / dist
+
+    def batch(self, trials: t.List["optuna.Trial"], executor: ThreadPoolExecutor) -> t.List[float]:
+        params = [self.suggest(trial) for trial in trials]
+        values = [self.estimate(trial, *p) for trial, p in zip(trials, params)]
+
+        pairs = {(fps_key(fps), size): (fps, size) for (fps, size), value in zip(params, values) if value is None}
+
+        self.optimizer._to_gif_ffmpeg_batch(list(pairs.values()))
+
+        # bisect the lowest lossy value that fits for every pair in lockstep
+        lossy_values = self.lossy_values()
+        bounds = {key: (0, len(lossy_values)) for key in pairs}
+        file_sizes: t.Dict[t.Tuple[int, int, int], int] = {}
+
+        def measure(keys: t.List[t.Tuple[int, int, int]]):
+            keys = [key for key in keys if key not in file_sizes]
+            results = executor.map(lambda key: self.optimizer._to_gif(*pairs[key[:2]], key[2])[1], keys)
+            for key, file_size in zip(keys, results):
+                file_sizes[key] = file_size
+                self.estimator.add(self.optimizer._pixels(*pairs[key[:2]]), key[2], file_size)
+
+        def oversized(key: t.Tuple[int, int], lossy: int) -> bool:
+            estimate = self.estimator.estimate(self.optimizer._pixels(*pairs[key]), lossy)
+            return estimate is not None and estimate > self.ESTIMATE_MARGIN * self.output_size_limit
+
+        while True:
+            steps = {}
+            for key, (lo, hi) in bounds.items():
+                while lo < hi and oversized(key, lossy_values[(lo + hi) // 2]):
+                    lo = (lo + hi) // 2 + 1
+                bounds[key] = (lo, hi)
+                if lo < hi:
+                    steps[key] = (lo + hi) // 2
+            if not steps:
+                break
+
+            render = {(*key, lossy_values[mid]): None for key, mid in steps.items()}
+
+            # threads left idle run gifsicle for both possible next steps
+            spare = len(trials) - len(render)
+            for key, mid in steps.items():
+                lo, hi = bounds[key]
+                for next_mid in ((lo + mid) // 2, (mid + 1 + hi) // 2):
+                    if spare <= 0 or next_mid == mid or not (lo <= next_mid < hi):
+                        continue
+                    next_key = (*key, lossy_values[next_mid])
+                    if next_key not in render and next_key not in file_sizes:
+                        render[next_key] = None
+                        spare -= 1
+
+            measure(list(render))
+
+            for key, mid in steps.items():
+                lo, hi = bounds[key]
+                if file_sizes[(*key, lossy_values[mid])] <= self.output_size_limit:
+                    bounds[key] = (lo, mid)
+                else:
+                    bounds[key] = (mid + 1, hi)
+
+        # when nothing fits the most lossy gif is the closest
+        lossy_found = {key: lossy_values[min(lo, len(lossy_values) - 1)] for key, (lo, _) in bounds.items()}
+        measure([(*key, lossy) for key, lossy in lossy_found.items()])
+
+        for i, (fps, size) in enumerate(params):
+            lossy = self.lossy_high
+            if values[i] is None:
+                key = (fps_key(fps), size)
+                lossy = lossy_found[key]
+                values[i] = self.value(fps, size, lossy, file_sizes[(*key, lossy)])
+            trials[i].set_user_attr("lossy", lossy)
+            print(f"trial {trials[i].number}: {fps=:.2f} {size=} {lossy=} value={values[i]:.2f}")
+
+        return values
+
+
+def run_trials(
+    study: "optuna.Study",
+    objective: Objective,
+    n_trials: t.Optional[int],
+    timeout: t.Optional[int],
+    batch_size: int,
+    ask_lock: t.Optional[t.ContextManager] = None,
+    stop: t.Optional[Event] = None,
+):
+    import optuna
+
+    started = monotonic()
+    finished = 0
+
+    with ThreadPoolExecutor(max_workers=batch_size) as executor:
+        while n_trials is None or finished < n_trials:
+            if timeout is not None and monotonic() - started > timeout:
+                break
+            if stop is not None and stop.is_set():
+                break
+
+            n = batch_size if n_trials is None else min(batch_size, n_trials - finished)
+            with ask_lock or nullcontext():
+                trials = [study.ask() for _ in range(n)]
+            try:
+                values = objective.batch(trials, executor)
+            except BaseException:
+                for trial in trials:
+                    study.tell(trial, state=optuna.trial.TrialState.FAIL)
+                raise
+
+            for trial, value in zip(trials, values):
+                study.tell(trial, value)
+            finished += n
+
+
+class SizeEstimator:
+    # log(size) = a + b * log(pixels) + c * lossy, fitted by least squares
+    PARAMETERS = 3
+
+    def __init__(self):
+        self._xx = [[0.0] * self.PARAMETERS for _ in range(self.PARAMETERS)]
+        self._xy = [0.0] * self.PARAMETERS
+        self._pixels: t.Set[float] = set()
+        self._coefficients: t.Optional[t.List[float]] = None
+
+    def add(self, pixels: t.Optional[float], lossy: int, size: int):
+        if pixels is None or pixels <= 0 or size <= 0:
+            return
+
+        x = (1.0, log(pixels), float(lossy))
+        y = log(size)
+        for i in range(self.PARAMETERS):
+            self._xy[i] += x[i] * y
+            for j in range(self.PARAMETERS):
+                self._xx[i][j] += x[i] * x[j]
+
+        if len(self._pixels) < self.PARAMETERS:
+            self._pixels.add(pixels)
+        self._coefficients = None
+
+    def estimate(self, pixels: t.Optional[float], lossy: int) -> t.Optional[float]:
+        if pixels is None or pixels <= 0 or len(self._pixels) < self.PARAMETERS:
+            return None
+
+        if self._coefficients is None:
+            self._coefficients = solve(self._xx, self._xy)
+            if self._coefficients is None:
+                return None
+
+        a, b, c = self._coefficients
+        # keeps exp from overflowing
+        return exp(min(a + b * log(pixels) + c * lossy, 50.0))
+
+
+def optimize_worker(
+    objective: Objective,
+    study_name: str,
+    storage: str,
+    n_trials: t.Optional[int],
+    timeout: t.Optional[int],
+    batch_size: int,
+    ask_lock: t.ContextManager,
+    stop: Event,
+):
+    import optuna
+
+    study = optuna.load_study(study_name=study_name, storage=storage)
+    try:
+        run_trials(study, objective, n_trials, timeout, batch_size, ask_lock, stop)
+    except KeyboardInterrupt:
+        pass
+
+
+def split_trials(trials: t.Optional[int], jobs: int) -> t.List[t.Optional[int]]:
+    if trials is None:
+        return [None] * jobs
+    n, rest = divmod(trials, jobs)
+    split = [n + 1] * rest + [n] * (jobs - rest)
+    return [n for n in split if n > 0]
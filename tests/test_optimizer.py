@@ -0,0 +1,282 @@
+import io
+import tempfile
+import threading
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import redirect_stdout
+from math import exp, log
+from pathlib import Path
+from unittest import mock
+
+from gif_slacker.optimizer import Objective, Optimizer, SizeEstimator, fps_filter, solve, split_trials
+
+
+class TestSolve(unittest.TestCase):
+    def test_solves_system(self):
+        a = [[2.0, 1.0, -1.0], [-3.0, -1.0, 2.0], [-2.0, 1.0, 2.0]]
+        b = [8.0, -11.0, -3.0]
+        x = solve(a, b)
+        for value, expected in zip(x, [2.0, 3.0, -1.0]):
+            self.assertAlmostEqual(value, expected)
+
+    def test_needs_pivoting(self):
+        x = solve([[0.0, 1.0], [1.0, 0.0]], [2.0, 3.0])
+        self.assertAlmostEqual(x[0], 3.0)
+        self.assertAlmostEqual(x[1], 2.0)
+
+    def test_singular(self):
+        self.assertIsNone(solve([[1.0, 2.0], [2.0, 4.0]], [1.0, 2.0]))
+        self.assertIsNone(solve([[0.0, 0.0], [0.0, 0.0]], [0.0, 0.0]))
+
+
+class TestSizeEstimator(unittest.TestCase):
+    def test_fits_log_linear_model(self):
+        a, b, c = 1.5, 0.8, -0.01
+        estimator = SizeEstimator()
+        for pixels in (1e5, 1e6, 1e7):
+            for lossy in (0, 100, 200):
+                estimator.add(pixels, lossy, exp(a + b * log(pixels) + c * lossy))
+
+        estimate = estimator.estimate(5e6, 50)
+        self.assertAlmostEqual(estimate, exp(a + b * log(5e6) + c * 50), delta=estimate * 1e-9)
+
+    def test_needs_different_pixel_counts(self):
+        estimator = SizeEstimator()
+        self.assertIsNone(estimator.estimate(1e6, 0))
+
+        for lossy in range(0, 200, 10):
+            estimator.add(1e6, lossy, 1000 - lossy)
+            estimator.add(2e6, lossy, 2000 - lossy)
+        self.assertIsNone(estimator.estimate(1e6, 0))
+
+    def test_ignores_unknown_pixels(self):
+        estimator = SizeEstimator()
+        estimator.add(None, 0, 1000)
+        for pixels in (1e5, 1e6, 1e7):
+            estimator.add(pixels, 0, pixels / 10)
+        self.assertIsNone(estimator.estimate(None, 0))
+
+
+class TestFpsFilter(unittest.TestCase):
+    def test_same_fps(self):
+        self.assertEqual(fps_filter(30, 30), "null")
+        self.assertEqual(fps_filter(29.97, 29.97), "null")
+
+    def test_divisor(self):
+        self.assertEqual(fps_filter(30, 15), "select='not(mod(n,2))'")
+        self.assertEqual(fps_filter(30, 10), "select='not(mod(n,3))'")
+
+    def test_resample(self):
+        self.assertEqual(fps_filter(30, 12), "fps=12.00")
+        self.assertEqual(fps_filter(29.97, 15.5), "fps=15.50")
+
+
+class TestSplitTrials(unittest.TestCase):
+    def test_even(self):
+        self.assertEqual(split_trials(8, 4), [2, 2, 2, 2])
+
+    def test_uneven(self):
+        self.assertEqual(split_trials(10, 4), [3, 3, 2, 2])
+
+    def test_fewer_trials_than_jobs(self):
+        self.assertEqual(split_trials(2, 4), [1, 1])
+
+    def test_unlimited(self):
+        self.assertEqual(split_trials(None, 3), [None, None, None])
+
+
+def objective(optimizer=None, **kwargs) -> Objective:
+    params = dict(
+        output_size_limit=1000,
+        fps_min=1,
+        fps_max=30,
+        size_min=8,
+        size_max=320,
+        lossy_min=0,
+        lossy_max=200,
+    )
+    params.update(kwargs)
+    return Objective(optimizer, **params)
+
+
+class TestObjectiveSteps(unittest.TestCase):
+    def test_fps_steps_down_from_fps_max(self):
+        o = objective(fps_min=1, fps_max=29.97)
+        self.assertEqual(o.fps_steps, 28)
+        self.assertEqual(o.fps_step, 1)
+        self.assertAlmostEqual(o.fps_low, 1.97)
+        self.assertAlmostEqual(o.fps_high, 29.97)
+
+    def test_narrow_fps_range_is_continuous(self):
+        o = objective(fps_min=10.2, fps_max=10.8)
+        self.assertEqual(o.fps_steps, 0)
+        self.assertIsNone(o.fps_step)
+        self.assertEqual((o.fps_low, o.fps_high), (10.2, 10.8))
+        self.assertIsNone(o.grid())
+
+    def test_lossy_steps(self):
+        o = objective(lossy_min=3, lossy_max=200)
+        self.assertEqual(o.lossy_high, 198)
+        self.assertEqual(o.lossy_values()[:3], [3, 8, 13])
+        self.assertEqual(o.lossy_values()[-1], 198)
+
+    def test_grid(self):
+        o = objective(fps_min=28, fps_max=30, size_min=40, size_max=41)
+        self.assertEqual(o.grid(), {"fps": [28.0, 29.0, 30.0], "size": [40, 41]})
+
+
+class StubOptimizer:
+    def __init__(self, file_size):
+        self.file_size = file_size
+        self.rendered = []
+        self.compressed = []
+        self._lock = threading.Lock()
+
+    def _pixels(self, fps, size):
+        return fps * size * size * 100
+
+    def _to_gif_ffmpeg_batch(self, pairs):
+        self.rendered.append(pairs)
+
+    def _to_gif(self, fps, size, lossy):
+        with self._lock:
+            self.compressed.append(lossy)
+        return Path(f"{fps}-{size}-{lossy}.gif"), self.file_size(fps, size, lossy)
+
+
+class StubTrial:
+    def __init__(self, number, fps, size):
+        self.number = number
+        self.params = {"fps": fps, "size": size}
+        self.user_attrs = {}
+
+    def suggest_float(self, name, low, high, step=None):
+        return self.params[name]
+
+    def suggest_int(self, name, low, high, log=False):
+        return self.params[name]
+
+    def set_user_attr(self, key, value):
+        self.user_attrs[key] = value
+
+
+class TestObjectiveBatch(unittest.TestCase):
+    def batch(self, o, trials):
+        with ThreadPoolExecutor(max_workers=len(trials)) as executor, redirect_stdout(io.StringIO()):
+            return o.batch(trials, executor)
+
+    def test_bisects_lowest_fitting_lossy(self):
+        optimizer = StubOptimizer(lambda fps, size, lossy: 1000 - 4 * lossy)
+        o = objective(optimizer, output_size_limit=700)
+        trial = StubTrial(0, 10.0, 100)
+
+        values = self.batch(o, [trial])
+
+        self.assertEqual(trial.user_attrs["lossy"], 75)
+        self.assertEqual(values, [o.value(10.0, 100, 75, 700)])
+        self.assertEqual(optimizer.rendered, [[(10.0, 100)]])
+        self.assertLessEqual(len(optimizer.compressed), 6)
+
+    def test_nothing_fits(self):
+        optimizer = StubOptimizer(lambda fps, size, lossy: 2000)
+        o = objective(optimizer, lossy_max=198)
+        trial = StubTrial(0, 10.0, 100)
+
+        values = self.batch(o, [trial])
+
+        self.assertEqual(trial.user_attrs["lossy"], 195)
+        self.assertEqual(values, [o.value(10.0, 100, 195, 2000)])
+        self.assertGreater(values[0], o.output_size_limit)
+
+    def test_duplicate_pairs(self):
+        optimizer = StubOptimizer(lambda fps, size, lossy: 1000 - 4 * lossy)
+        o = objective(optimizer, output_size_limit=700)
+        trials = [StubTrial(0, 10.0, 100), StubTrial(1, 10.0, 100)]
+
+        values = self.batch(o, trials)
+
+        self.assertEqual(optimizer.rendered, [[(10.0, 100)]])
+        self.assertEqual(values[0], values[1])
+        self.assertEqual(len(optimizer.compressed), len(set(optimizer.compressed)))
+
+    def test_skips_estimated_oversized(self):
+        optimizer = StubOptimizer(lambda fps, size, lossy: 1000 - 4 * lossy)
+        o = objective(optimizer)
+        for pixels in (1e6, 2e6, 4e6):
+            for lossy in (0, 200):
+                o.estimator.add(pixels, lossy, pixels / 10 - lossy)
+        trial = StubTrial(0, 10.0, 100)
+
+        values = self.batch(o, [trial])
+
+        self.assertEqual(optimizer.rendered, [[]])
+        self.assertEqual(optimizer.compressed, [])
+        self.assertTrue(trial.user_attrs["estimated"])
+        self.assertEqual(trial.user_attrs["lossy"], o.lossy_high)
+        self.assertGreater(values[0], o.output_size_limit)
+
+    def test_spare_threads_compress_next_steps(self):
+        optimizer = StubOptimizer(lambda fps, size, lossy: 1000 - 4 * lossy)
+        o = objective(optimizer, output_size_limit=700)
+        trials = [StubTrial(i, 10.0, 100) for i in range(3)]
+
+        self.batch(o, trials)
+
+        # the first step is the middle value and both values it may lead to
+        self.assertEqual(set(optimizer.compressed[:3]), {50, 100, 155})
+        self.assertEqual({trial.user_attrs["lossy"] for trial in trials}, {75})
+
+
+class TestFfmpegBatch(unittest.TestCase):
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+
+        with mock.patch.object(Optimizer, "_update_fps_and_size"):
+            self.optimizer = Optimizer(Path("video.mp4"), dir=tmp.name)
+        self.addCleanup(self.optimizer.__exit__, None, None, None)
+        self.optimizer.fps, self.optimizer.width, self.optimizer.height = 30.0, 320, 240
+        self.optimizer._has_palette = True
+
+        self.calls = []
+        patcher = mock.patch("gif_slacker.optimizer.cmd", side_effect=self.cmd)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def cmd(self, *args, check=False, capture=True):
+        self.calls.append(args)
+        for arg, output_file in zip(args, args[1:]):
+            if arg == "gif":
+                Path(output_file).touch()
+        return 0, b"", b""
+
+    def test_renders_missing_pairs_in_one_run(self):
+        self.optimizer._to_gif_ffmpeg_batch([(15.0, 100), (12.0, 200), (15.0, 100)])
+
+        self.assertEqual(len(self.calls), 1)
+        args = self.calls[0]
+        self.assertEqual(
+            args[args.index("-filter_complex") + 1],
+            "[0:v]split=2[s0][s1];"
+            "[1:v]split=2[p0][p1];"
+            "[s0]select='not(mod(n,2))',scale=100:-1:flags=lanczos[v0];"
+            "[v0][p0]paletteuse[g0];"
+            "[s1]fps=12.00,scale=200:-1:flags=lanczos[v1];"
+            "[v1][p1]paletteuse[g1]",
+        )
+        self.assertEqual([args[i + 1] for i, arg in enumerate(args) if arg == "-map"], ["[g0]", "[g1]"])
+        self.assertTrue(self.optimizer._to_gif_ffmpeg(15.0, 100).exists())
+        self.assertTrue(self.optimizer._to_gif_ffmpeg(12.0, 200).exists())
+        self.assertEqual(len(self.calls), 1)
+
+    def test_single_missing_pair(self):
+        self.optimizer._to_gif_ffmpeg_batch([(15.0, 100)])
+        self.optimizer._to_gif_ffmpeg_batch([(15.0, 100), (10.0, 50)])
+
+        self.assertEqual(len(self.calls), 2)
+        args = self.calls[1]
+        self.assertEqual(args[args.index("-lavfi") + 1], "select='not(mod(n,3))',scale=50:-1:flags=lanczos,paletteuse")
+
+
+if __name__ == "__main__":
+    unittest.main()